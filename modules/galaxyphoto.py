@@ -38,6 +38,48 @@ class Galaxy:
         self.mag_err = 2.5/np.log(10) * self.flux_err/self.fluxes
 
 
+class GalaxyCollection:
+    '''
+    A list of galaxies stored as flat arrays, so that the photometry of all
+    the galaxies can be operated on at once.
+    
+    redshifts has one entry per galaxy. wavelen, fluxes, flux_err and filters
+    are the concatenated photometry of all the galaxies, and the photometry of
+    galaxy i is in the slice indptr[i]:indptr[i+1]. one_plus_z holds 1+z
+    for each galaxy, calculated in the precision of that galaxy's redshift
+    (some catalogs store float32 redshifts), so that redshifted grids match
+    those calculated from the galaxy itself. obs_one_plus_z is the same for 
+    each observation.
+    Iterating over the collection yields Galaxy objects whose arrays are views
+    into the flat arrays.
+    '''
+    def __init__(self, galaxies):
+        galaxies = list(galaxies)
+        counts = np.array([len(galaxy.fluxes) for galaxy in galaxies], dtype=int)
+        self.indptr = np.concatenate(([0], np.cumsum(counts)))
+        self.redshifts = np.array([galaxy.redshift for galaxy in galaxies], dtype=float)
+        self.one_plus_z = np.array([1 + galaxy.redshift for galaxy in galaxies], dtype=float)
+        self.obs_one_plus_z = np.repeat(self.one_plus_z, counts)
+        if len(galaxies) == 0:
+            self.wavelen = self.fluxes = self.flux_err = np.array([], dtype=float)
+            self.filters = np.array([], dtype=str)
+        else:
+            self.wavelen = np.concatenate([galaxy.wavelen for galaxy in galaxies]).astype(float)
+            self.fluxes = np.concatenate([galaxy.fluxes for galaxy in galaxies]).astype(float)
+            self.flux_err = np.concatenate([galaxy.flux_err for galaxy in galaxies]).astype(float)
+            self.filters = np.concatenate([galaxy.filters for galaxy in galaxies])
+
+    def __len__(self):
+        return len(self.redshifts)
+
+    def __iter__(self):
+        for i,z in enumerate(self.redshifts):
+            lo, hi = self.indptr[i], self.indptr[i+1]
+            yield Galaxy(wavelen=self.wavelen[lo:hi], fluxes=self.fluxes[lo:hi],
+                        flux_err=self.flux_err[lo:hi], filters=self.filters[lo:hi],
+                        redshift=z)
+
+
 class Bandpass:
     '''
     Class defining a bandpass filter
@@ -70,16 +112,69 @@ def get_bandpass_dict(filter_loc='filters/',dlambda=20):
         bandpass_dict[names[i]] = bandpass  
     return bandpass_dict
 
+def _stack_responses(bandpass_dict):
+    """
+    Return the normalized responses of all the bandpasses in bandpass_dict,
+    zero padded into a single 2D array, along with the start, step, and length
+    of each bandpass wavelength grid, and a dictionary mapping filter names to
+    rows of the array. The grids are uniform, so they can be interpolated
+    onto together with _interp_responses.
+    """
+    names = list(bandpass_dict.keys())
+    npts = np.array([len(bandpass_dict[name].wavelen) for name in names])
+    R_stack = np.zeros((len(names), npts.max()))
+    wl_start = np.zeros(len(names))
+    wl_step = np.zeros(len(names))
+    for i,name in enumerate(names):
+        bandpass = bandpass_dict[name]
+        R_stack[i,:npts[i]] = bandpass.R
+        wl_start[i] = bandpass.wavelen[0]
+        wl_step[i] = bandpass.wavelen[1] - bandpass.wavelen[0]
+    index = {name: i for i,name in enumerate(names)}
+    return R_stack, wl_start, wl_step, npts, index
+
+def _interp_responses(x, fidx, R_stack, wl_start, wl_step, npts):
+    """
+    Return the responses of the filters in rows fidx of R_stack, linearly 
+    interpolated onto the wavelengths x. Equivalent to np.interp for each
+    filter, including holding the edge values outside the bandpass.
+    """
+    last = npts[fidx,None] - 1
+    pos = np.clip((x - wl_start[fidx,None])/wl_step[fidx,None], 0, last)
+    lo = np.minimum(pos.astype(int), last - 1)
+    frac = pos - lo
+    rows = np.asarray(fidx)[:,None]
+    return R_stack[rows,lo]*(1-frac) + R_stack[rows,lo+1]*frac
+
+def _flux_matrix(wavelen, fidx, R_stack, wl_start, wl_step, npts):
+    """
+    Return the matrix Phi such that Phi @ flambda is the list of fluxes of the
+    SED (wavelen, flambda) in the filters in rows fidx of R_stack (see 
+    _stack_responses). The interpolation in _flux is linear in flambda, so this
+    is identical to _fluxlist, but Phi can be reused for any flambda on wavelen.
+    """
+    nbins = len(wavelen)
+    nfilt = len(fidx)
+    # bandpass grids, where padded points have zero response
+    x = wl_start[fidx,None] + wl_step[fidx,None] * np.arange(R_stack.shape[1])
+    # interpolation weights of the neighboring template bins, holding the
+    # edge values outside of wavelen like np.interp
+    j = np.clip(np.searchsorted(wavelen, x, side='right') - 1, 0, nbins-2)
+    t = np.clip((x - wavelen[j])/(wavelen[j+1] - wavelen[j]), 0, 1)
+    Rdl = R_stack[fidx] * wl_step[fidx,None]
+    # scatter the weighted response onto the template bins
+    idx = np.arange(nfilt)[:,None]*nbins + j
+    Phi = np.bincount(idx.ravel(), (Rdl*(1-t)).ravel(), minlength=nfilt*nbins)
+    Phi += np.bincount((idx+1).ravel(), (Rdl*t).ravel(), minlength=nfilt*nbins)
+    return Phi.reshape(nfilt,nbins)
+
 def get_mean_wavelen(bandpass_dict, filters=None):
     """
     Return the mean wavelengths for a list of filters
     """
     if filters is None:
         filters = bandpass_dict.keys()
-    mean_wavelens = np.array([])
-    for name in filters:
-        band = bandpass_dict[name]
-        mean_wavelens = np.append(mean_wavelens,band.mean_wavelen)
+    mean_wavelens = np.array([bandpass_dict[name].mean_wavelen for name in filters])
     return mean_wavelens
 
 
@@ -92,6 +187,11 @@ class Sed:
     fluxlist will return list of fluxes for the filters in the provided
     bandpass_dict. If you provide the list filters, it will only provide
     fluxes for those filters.
+    widths will return the widths of the wavelength bins, with the last
+    bin as wide as the one before it. These are cached until wavelen changes.
+    clone will return a copy of the SED, much faster than copy.deepcopy. 
+    The copy shares wavelen with the original unless copy_wavelen=True, 
+    which is required if either will be redshifted.
     """
     '''Class defining an SED'''
     def __init__(self, wavelen=None, flambda=None):
@@ -100,17 +200,47 @@ class Sed:
         
     def redshift(self, z):
         self.wavelen *= (1 + z)
+        self._widths = None
+
+    def clone(self, copy_wavelen=False):
+        wavelen = self.wavelen.copy() if copy_wavelen else self.wavelen
+        return Sed(wavelen, self.flambda.copy())
+
+    def widths(self):
+        # the cache remembers the grid it was computed for, in case wavelen is replaced
+        cache = getattr(self, '_widths', None)
+        if cache is None or cache[0] is not self.wavelen:
+            widths = np.diff(self.wavelen)
+            widths = np.append(widths,widths[-1])
+            self._widths = (self.wavelen, widths)
+        return self._widths[1]
         
     def flux(self, bandpass):
-        y = np.interp(bandpass.wavelen,self.wavelen,self.flambda)
-        flux = (y*bandpass.R).sum() * (bandpass.wavelen[1] - bandpass.wavelen[0])
-        return flux
+        return _flux(self.wavelen, self.flambda, bandpass)
     
     def fluxlist(self, bandpass_dict, filters=None):
-        if filters is None:
-            filters = bandpass_dict.keys()
-        fluxes = []
-        for name in filters:
-            bandpass = bandpass_dict[name]
-            fluxes.append(self.flux(bandpass))
-        return np.array(fluxes)
\ No newline at end of file
+        return _fluxlist(self.wavelen, self.flambda, bandpass_dict, filters)
+
+
+def _flux(wavelen, flambda, bandpass):
+    """
+    Return the flux of the SED defined by the arrays wavelen and flambda
+    in the provided bandpass. Lets callers pass a shifted wavelength grid
+    instead of copying and redshifting an Sed.
+    """
+    y = np.interp(bandpass.wavelen,wavelen,flambda)
+    flux = (y*bandpass.R).sum() * (bandpass.wavelen[1] - bandpass.wavelen[0])
+    return flux
+
+def _fluxlist(wavelen, flambda, bandpass_dict, filters=None):
+    """
+    Return array of fluxes of the SED defined by the arrays wavelen and 
+    flambda, for the filters in bandpass_dict (or only those in filters)
+    """
+    if filters is None:
+        filters = bandpass_dict.keys()
+    fluxes = []
+    for name in filters:
+        bandpass = bandpass_dict[name]
+        fluxes.append(_flux(wavelen, flambda, bandpass))
+    return np.array(fluxes)
\ No newline at end of file
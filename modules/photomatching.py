@@ -5,9 +5,10 @@ import numpy as np
 import copy
 import multiprocessing as mp
 import functools
+from modules.galaxyphoto import get_mean_wavelen, _fluxlist
 
 
-def create_training_sets(galaxies, template_dict, bandpass_dict, Ncpus=None):
+def create_training_sets(galaxies, template_dict, bandpass_dict, Ncpus=None, Ntop=None):
     """
     Returns a dictionary of training sets for each template in template dict.
 
@@ -16,19 +17,17 @@ def create_training_sets(galaxies, template_dict, bandpass_dict, Ncpus=None):
     Each training set is a list of the matched galaxies.
     The matching is performed in parallel, using the number of CPU's specified
     by Ncpus. If none specified, will use all CPU's available.
+    Ntop sets the number of templates kept by the prescreen in match_photometry.
     """
 
-    # create the cpu pool to match galaxies in parallel
+    # create the cpu pool to match galaxies in parallel. The templates and
+    # bandpasses are sent to each worker once, rather than with every galaxy
     Ncpus = mp.cpu_count() if Ncpus is None else Ncpus
-    pool = mp.Pool(Ncpus)
-
-    # match the galaxies
-    galaxies_ = pool.starmap(match_galaxy,
-                                [(galaxy,template_dict,bandpass_dict) 
-                                    for galaxy in galaxies])
-
-    # close the cpu pool
-    pool.close()
+    with mp.Pool(Ncpus, initializer=_init_worker,
+                 initargs=(template_dict,bandpass_dict,Ntop)) as pool:
+        # match the galaxies, in chunks to cut down on inter-process traffic
+        chunksize = max(1, len(galaxies)//(4*Ncpus))
+        galaxies_ = pool.map(_match_galaxy_worker, galaxies, chunksize)
 
     # assemble the dictionary of matched galaxies
     training_sets = dict()
@@ -43,14 +42,29 @@ def create_training_sets(galaxies, template_dict, bandpass_dict, Ncpus=None):
 
 
 
-def match_galaxy(galaxy, template_dict, bandpass_dict):
+# templates and bandpasses used by the workers of create_training_sets
+_worker_dicts = dict()
+
+def _init_worker(template_dict, bandpass_dict, Ntop):
+    _worker_dicts['templates'] = template_dict
+    _worker_dicts['bandpasses'] = bandpass_dict
+    _worker_dicts['Ntop'] = Ntop
+
+def _match_galaxy_worker(galaxy):
+    return match_galaxy(galaxy, _worker_dicts['templates'], _worker_dicts['bandpasses'],
+                        _worker_dicts['Ntop'])
+
+
+
+def match_galaxy(galaxy, template_dict, bandpass_dict, Ntop=None):
     """
     Return galaxy with galaxy.template equal to the matching template
     in template_dict, using the filters in bandpass_dict.
+    See match_photometry for Ntop.
     """
 
     galaxy_ = copy.deepcopy(galaxy)
-    template,scale = match_photometry(galaxy,template_dict,bandpass_dict)
+    template,scale = match_photometry(galaxy,template_dict,bandpass_dict,Ntop)
     galaxy_.fluxes *= scale
     galaxy_.flux_err *= scale
     galaxy_.fluxTomag()
@@ -60,44 +74,84 @@ def match_galaxy(galaxy, template_dict, bandpass_dict):
 
 
 
-def match_photometry(galaxy, template_dict, bandpass_dict):
+def match_photometry(galaxy, template_dict, bandpass_dict, Ntop=None):
     """
     Return the template and normalization matched to the galaxy photometry.
+
+    If Ntop is set, the templates are first ranked with a cheap estimate of
+    the mse that uses the template flux density at the mean wavelength of each
+    filter, and only the best Ntop are matched with the full synthetic photometry.
+    This is faster for large template sets, but the prescreen can occasionally
+    discard the template that would have matched best.
     """
 
     # list of templates
     keys = np.array(list(template_dict.keys()))
-    # arrays to store the mean square errors and the normalizations
-    mse_list = np.array([])
-    norms = np.array([])
-    
-    # calculate mse and norm for each template
-    for template in template_dict.values():
-
-        # make a copy of the fluxes and fractional errors
-        fluxes = galaxy.fluxes.copy()
-        errs = galaxy.flux_err/galaxy.fluxes
-        
-        # calculate redshift template fluxes
-        sed = copy.deepcopy(template)
-        sed.redshift(galaxy.redshift)
-        template_fluxes = sed.fluxlist(bandpass_dict, galaxy.filters)
-        
-        # determine the median normalization
-        idx = np.where( template_fluxes > 0 )
-        norm = np.median(template_fluxes[idx]/fluxes[idx])
-        idx = (np.fabs(template_fluxes/fluxes - norm)).argmin()
-
-        # renormalize in median band
-        template_fluxes /= template_fluxes[idx]
-        fluxes /= fluxes[idx]
-        
-        # calculate the mse
-        mse = np.mean(1/errs**2*(template_fluxes - fluxes)**2)
-        mse_list = np.append(mse_list, mse)
-        norms = np.append(norms, norm)
+    templates = list(template_dict.values())
+
+    # fractional errors
+    errs = galaxy.flux_err/galaxy.fluxes
+
+    # keep only the most promising templates
+    if Ntop is not None and Ntop < len(keys):
+        mean_wavelens = get_mean_wavelen(bandpass_dict, galaxy.filters)/(1+galaxy.redshift)
+        template_fluxes = np.array([np.interp(mean_wavelens, template.wavelen, template.flambda)
+                                    for template in templates])
+        screen,_ = _normed_mse(template_fluxes, galaxy.fluxes, errs)
+        top = np.argsort(screen)[:Ntop]
+        keys = keys[top]
+        templates = [templates[i] for i in top]
+
+    # calculate the fluxes of each template, then the mse and norm of all
+    # of them at once
+    template_fluxes = _template_fluxes(templates, galaxy, bandpass_dict)
+    mse_list,norms = _normed_mse(template_fluxes, galaxy.fluxes, errs)
         
     # identify the template with the lowest mse, 
     # and return it with the norm
     idx = mse_list.argmin()
-    return keys[idx],norms[idx]
\ No newline at end of file
+    return keys[idx],norms[idx]
+
+
+
+def _template_fluxes(templates, galaxy, bandpass_dict):
+    """
+    Return the fluxes of all the templates, redshifted to the redshift of
+    the galaxy, in the galaxy's filters, as an array of shape 
+    (len(templates), len(galaxy.filters)).
+    """
+
+    # The fluxes are deliberately calculated with _fluxlist rather than a
+    # shared flux matrix. With an even number of filters, the two middle bands
+    # are equally close to the median normalization in _normed_mse, so the
+    # choice between them (and hence the match) depends on the last bits of 
+    # the fluxes.
+    w_shift = [template.wavelen * (1+galaxy.redshift) for template in templates]
+    return np.array([_fluxlist(w, template.flambda, bandpass_dict, galaxy.filters)
+                     for w,template in zip(w_shift,templates)])
+
+
+
+def _normed_mse(template_fluxes, fluxes, errs):
+    """
+    Return the mse between the template fluxes and the galaxy fluxes, after 
+    normalizing both in the band closest to the median normalization, as 
+    well as that median normalization.
+    template_fluxes is a 2D array with a row for each template, and arrays of
+    the mse's and normalizations are returned.
+    """
+
+    rows = np.arange(len(template_fluxes))
+
+    # determine the median normalization, using the bands with positive flux
+    ratios = template_fluxes/fluxes
+    norm = np.nanmedian(np.where(template_fluxes > 0, ratios, np.nan), axis=1)
+    idx = (np.fabs(ratios - norm[:,None])).argmin(axis=1)
+
+    # renormalize in median band
+    template_fluxes = template_fluxes/template_fluxes[rows,idx][:,None]
+    fluxes = fluxes/fluxes[idx][:,None]
+    
+    # calculate the mse
+    mse = np.mean(1/errs**2*(template_fluxes - fluxes)**2, axis=1)
+    return mse,norm
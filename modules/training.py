@@ -1,12 +1,15 @@
 
 import numpy as np 
-import copy
 import multiprocessing as mp
 from scipy.signal import medfilt
-from modules.galaxyphoto import Sed
+from scipy.linalg import cho_factor, cho_solve
+from scipy.linalg.blas import dsyrk
+from modules.galaxyphoto import Sed, GalaxyCollection, _stack_responses, _interp_responses, _flux_matrix
 from modules.photomatching import create_training_sets
 
 
+
+
 def log_norm(x, mode, sigma, norm):
     """
     Log normal distribution normalized at the wavelength "norm"
@@ -45,7 +48,7 @@ def new_naive_templates(N, res=100, x_min=10, x_max=15000,
 def train_templates(galaxies, template_dict, bandpass_dict,
                     w=0.5, Delta=None, dmse_stop=0.05, 
                     maxRounds=None, maxPerts=None, renorm=5000, 
-                    Ncpus=None, verbose=True):
+                    Ncpus=None, Ntop=None, verbose=True):
     """
     Trains a dictionary of templates on a list of galaxies, using the algorithm
     described in the paper. Returns the trained templates, and a training history
@@ -63,13 +66,16 @@ def train_templates(galaxies, template_dict, bandpass_dict,
     round. These are just maxima. If you want to enforce those numbers of rounds/perturbations,
     then set dmse_stop=0.
     Ncpus is the number of cpus to use in the photometry matching/template training when parallelizing
+    Ntop is the number of templates kept by the prescreen in the photometry matching.
+    See match_photometry in photomatching.py.
     """
 
     if verbose:
         print("Columns: Template, number of perturbations, initial/final wMSE")
 
     # new templates to be perturbed
-    new_templates = copy.deepcopy(template_dict)
+    new_templates = {key: template.clone(copy_wavelen=True)
+                     for key,template in template_dict.items()}
 
     # create the history and mse0 dictionaries
     history = dict()
@@ -86,14 +92,16 @@ def train_templates(galaxies, template_dict, bandpass_dict,
 
         # create the training sets for this round
         training_sets = create_training_sets(galaxies, new_templates,
-                                             bandpass_dict, Ncpus)
+                                             bandpass_dict, Ncpus, Ntop)
 
         # create the cpu pool to perturb galaxies in parallel
         Ncpus = mp.cpu_count() if Ncpus is None else Ncpus
         with mp.Pool(Ncpus) as pool:
             # perturb each template (unless already matches photometry well)
+            # the training sets are sent as flat arrays, which are much cheaper
+            # to pickle than lists of galaxies
             roundResult = pool.starmap(perturbation_round,
-                                        [(key, training_sets[key],
+                                        [(key, GalaxyCollection(training_sets[key]),
                                         new_templates[key],
                                         bandpass_dict, mse0[key], 
                                         w, Delta, dmse_stop, maxPerts)
@@ -103,9 +111,13 @@ def train_templates(galaxies, template_dict, bandpass_dict,
         totPerts = 0 
         for i in roundResult:
             key = i[0]
-            templates = i[1]
+            flambda_history = i[1]
             mse_list = i[2]
 
+            # rebuild the SEDs, which all share the wavelength grid of the template
+            wavelen = new_templates[key].wavelen
+            templates = [Sed(wavelen, flambda) for flambda in flambda_history]
+
             new_templates[key] = templates[-1]
             mse0[key] = mse_list[-1]
             history[key][roundN] = [templates,mse_list]
@@ -149,15 +161,27 @@ def perturbation_round(key,training_set, template, bandpass_dict, mse0,
     mse0 is the wMSE from the previous round. It will be used to determined if the 
     new photometry set is different enough to warrant further perturbations. It is
     then updated throughout this function to track when perturbations should end.
+
+    Returns the key, the list of template flambdas after each perturbation
+    (starting with the unperturbed template), and the list of wMSEs.
     """
+
+    if not isinstance(training_set, GalaxyCollection):
+        training_set = GalaxyCollection(training_set)
+
+    # the template grid is fixed for the whole round, so the redshifted
+    # responses and flux matrices are cached between the perturbations of 
+    # this template
+    cache = dict()
     
     # fractional change in mse from photometry matching
-    mse = calc_mse(training_set, template, bandpass_dict)
+    mse = calc_mse(training_set, template, bandpass_dict, cache)
     dmse = (mse - mse0)/mse0 
     mse0 = mse
 
+    # only the fluxes are saved, as the wavelength grid doesn't change
     mse_list = [mse]
-    templates = [copy.deepcopy(template)]
+    flambda_history = [template.flambda.copy()]
 
     # start perturbations
     pertN = 0
@@ -165,12 +189,12 @@ def perturbation_round(key,training_set, template, bandpass_dict, mse0,
         pertN += 1
 
         # perturb the template
-        sol = perturb_template(training_set, template, bandpass_dict, w, Delta)
+        sol = perturb_template(training_set, template, bandpass_dict, w, Delta, cache)
         template.flambda += sol
-        templates.append(copy.deepcopy(template))
+        flambda_history.append(template.flambda.copy())
         
         # calculate the new mse and the fractional change
-        mse = calc_mse(training_set, template, bandpass_dict)
+        mse = calc_mse(training_set, template, bandpass_dict, cache)
         dmse = (mse - mse0)/mse0 
         mse0 = mse # update mse0
         mse_list.append(mse)
@@ -178,82 +202,157 @@ def perturbation_round(key,training_set, template, bandpass_dict, mse0,
         if pertN == maxPerts:
             break
     
-    result = [key,templates,mse_list]
+    result = [key,flambda_history,mse_list]
     return result
 
 
 
-def perturb_template(training_set, template, bandpass_dict, w=0.5, Delta=None):
+def perturb_template(training_set, template, bandpass_dict, w=0.5, Delta=None, cache=None):
     """
     Perturbs the template according to the photometry in the training set, which
-    is a list of galaxy objects.
+    is a list of galaxy objects or a GalaxyCollection.
 
     bandpass_dict is the dictionary of filters used to observe the galaxies, and
     is used to calculate synthetic photometry for the template.
     w is the training ratio described in the paper and is used to calculate Delta.
     Values of order 1 work well.
     Delta can also be set manually.
+    cache is an optional dict in which the redshifted bandpass responses and
+    flux matrices are memoized, so they can be reused by later perturbations 
+    of the same template.
     """
     
+    if not isinstance(training_set, GalaxyCollection):
+        training_set = GalaxyCollection(training_set)
 
     wavelen = template.wavelen
+    cache = _grid_cache(cache, wavelen)
     nbins = len(wavelen)
-    widths = np.diff(wavelen)
-    widths = np.append(widths,widths[-1])
+    widths = template.widths()
+    responses = _stack_responses(bandpass_dict)
+
+    # synthetic photometry and fractional errors for every observation
+    template_fluxes = _synthetic_fluxes(training_set, template, responses, cache)
+    sigmas = training_set.flux_err/training_set.fluxes
+
+    # rows of the response matrix, one per observation, read straight from
+    # the flat arrays rather than building a Galaxy for each galaxy
+    indptr = training_set.indptr
+    A = np.concatenate([_rn_dlambda(wavelen, widths, one_plus_z,
+                                    training_set.filters[indptr[i]:indptr[i+1]],
+                                    responses, cache)
+                        for i,one_plus_z in enumerate(training_set.one_plus_z)])
+
+    # weight the rows and flux residuals by 1/sigma
+    A /= sigmas[:,None]
+    b = (training_set.fluxes - template_fluxes)/sigmas
+
+    # sum of the outer products of all rows. dsyrk only computes the upper
+    # triangle, and A.T is Fortran ordered so it is passed without a copy.
+    # The lower triangle is left empty, as the Cholesky factorization only
+    # reads the upper one
+    M = dsyrk(1.0, A.T)
+    nu = A.T @ b
 
-    M = np.zeros((nbins,nbins))
-    nu = np.zeros(nbins)
-    sigmas = np.array([])
+    if Delta is None:
+        Delta = np.mean(sigmas)*np.sqrt(nbins/(w*len(sigmas)))
+        Delta = np.clip(Delta,0,0.05)
+    M[np.diag_indices(nbins)] += 1/Delta**2
 
-    for galaxy in training_set:
+    # M is symmetric positive definite, so solve with a Cholesky factorization
+    c = cho_factor(M, lower=False, overwrite_a=True, check_finite=False)
+    sol = cho_solve(c, nu, check_finite=False)
 
-        template_ = copy.deepcopy(template)
-        template_.redshift(galaxy.redshift)
-        template_fluxes = template_.fluxlist(bandpass_dict, galaxy.filters)
+    return sol 
 
-        rn = np.array([np.interp(wavelen * (1+galaxy.redshift),
-                            bandpass_dict[band].wavelen, 
-                            bandpass_dict[band].R) for band in galaxy.filters])
-        dlambda = widths * (1+galaxy.redshift)
-        rn_dlambda = rn*dlambda.T
 
-        gn = galaxy.fluxes - template_fluxes
-        sigma_n = galaxy.flux_err/galaxy.fluxes
-        gos2 = gn/sigma_n**2
-        
-        M  += np.sum( [np.outer(row,row)/sigma_n[i]**2 for i,row in enumerate(rn_dlambda)], axis=0 )
-        nu += np.sum( (np.diag(gos2) @ rn_dlambda), axis=0 )
 
-        sigmas = np.concatenate((sigmas,sigma_n))
+def _grid_cache(cache, wavelen):
+    """
+    Return cache, a dict of quantities memoized for the template grid wavelen.
+    It is emptied first if it was filled for a different grid, and holds on to
+    wavelen so the grid can't be freed and replaced while it is in use. The
+    grid must not be changed in place (e.g. by Sed.redshift) while cached.
+    A new dict is returned if cache is None.
+    """
+    if cache is None:
+        return dict()
+    if cache.get('wavelen') is not wavelen:
+        cache.clear()
+        cache['wavelen'] = wavelen
+    return cache
 
-    if Delta is None:
-        Delta = np.mean(sigmas)*np.sqrt(len(template.wavelen)/(w*len(sigmas)))
-        Delta = np.clip(Delta,0,0.05)
-    M += np.identity(nbins)/Delta**2
 
-    sol = np.linalg.solve(M,nu)
 
-    return sol 
+def _rn_dlambda(wavelen, widths, one_plus_z, filters, responses, cache):
+    """
+    Return the responses of filters on the template grid wavelen redshifted by
+    the factor one_plus_z, multiplied by the redshifted bin widths. responses
+    is the output of _stack_responses, so all filters are interpolated in one
+    vectorized step. Results are memoized in cache (see _grid_cache), as the
+    same redshifts recur every perturbation.
+    """
+    key = ('rn', tuple(filters), one_plus_z)
+    rn_dlambda = cache.get(key)
+    if rn_dlambda is None:
+        R_stack, wl_start, wl_step, npts, index = responses
+        fidx = np.array([index[band] for band in filters])
+        rn = _interp_responses(wavelen * one_plus_z, fidx, R_stack, wl_start, wl_step, npts)
+        rn_dlambda = rn * widths * one_plus_z
+        cache[key] = rn_dlambda
+    return rn_dlambda
+
+
+
+def _synthetic_fluxes(galaxies, template, responses, cache):
+    """
+    Return the synthetic photometry of the template for every observation in the
+    GalaxyCollection galaxies. The fluxes in all filters are
+    calculated once per unique redshift (see _flux_matrix), then gathered for
+    each observation. The flux matrices are memoized in cache (see _grid_cache).
+    """
+    R_stack, wl_start, wl_step, npts, index = responses
+    all_bands = np.arange(len(R_stack))
+
+    # filter and redshift indices of the observations
+    names, name_inv = np.unique(galaxies.filters, return_inverse=True)
+    fidx = np.array([index[name] for name in names], dtype=int)[name_inv]
+    one_plus_zs, z_inv = np.unique(galaxies.obs_one_plus_z, return_inverse=True)
+
+    fluxes = np.empty((len(one_plus_zs),len(all_bands)))
+    for i,one_plus_z in enumerate(one_plus_zs):
+        key = ('phi', one_plus_z)
+        phi = cache.get(key)
+        if phi is None:
+            phi = _flux_matrix(template.wavelen * one_plus_z, all_bands,
+                                R_stack, wl_start, wl_step, npts)
+            cache[key] = phi
+        fluxes[i] = phi @ template.flambda
+
+    return fluxes[z_inv,fidx]
 
 
  
-def calc_mse(training_set, template, bandpass_dict):
+def calc_mse(training_set, template, bandpass_dict, cache=None):
     """
     Calculates the weighted mean square error (wMSE) between a set of observed galaxy photometry
     and synthetic photometry for an SED template.
+    The training set is a list of galaxy objects or a GalaxyCollection.
+    cache is an optional dict, shared with perturb_template, in which the flux
+    matrices of the template grid are memoized.
     """
     
-    se = 0
-    N = 0
-
-    for galaxy in training_set:
+    if not isinstance(training_set, GalaxyCollection):
+        training_set = GalaxyCollection(training_set)
+    cache = _grid_cache(cache, template.wavelen)
 
-        template_ = copy.deepcopy(template)
-        template_.redshift(galaxy.redshift)
-        template_fluxes = template_.fluxlist(bandpass_dict, galaxy.filters)
+    # synthetic photometry for every observation
+    template_fluxes = _synthetic_fluxes(training_set, template, 
+                                        _stack_responses(bandpass_dict), cache)
 
-        N += len(galaxy.fluxes)
-        se += sum( (galaxy.fluxes/galaxy.flux_err)**2 * (galaxy.fluxes - template_fluxes)**2 )
+    fluxes = training_set.fluxes
+    N = len(fluxes)
+    se = np.sum( (fluxes/training_set.flux_err)**2 * (fluxes - template_fluxes)**2 )
 
     mse = se/N
     return mse
\ No newline at end of file